@@ -3,7 +3,9 @@ from os import read # For reading CSV files
 import csv # For handling CSV files
 from turtle import pd # For data manipulation
 import pandas # For data manipulation
-from sklearn.cluster import KMeans # For K-Means clustering
+from sklearn.cluster import KMeans, MiniBatchKMeans # For K-Means clustering
+from joblib import Parallel, delayed # For clustering partitions in parallel
+import numpy # For array indexing of cluster labels
 from sklearn.preprocessing import StandardScaler # For feature scaling
 from enum import Enum # For creating enumerations
 import random # For random selections
@@ -12,20 +14,68 @@ from PIL import Image # For image handling
 import statistics # For statistical calculations
 import scipy.stats as stats # For statistical functions
 import math # For mathematical functions for statistics purposes
+import gzip # For gzip compressed exports
+import json # For JSON Lines exports
+import operator # For reading one attribute from many sets at once
+import os # For discarding output of replayed sessions
+import argparse # For command line options
+import multiprocessing # For replaying sessions concurrently
+from contextlib import contextmanager, redirect_stdout # For timing menu actions and silencing replayed sessions
+from time import perf_counter # For timing menu actions
+from collections import OrderedDict # For the least recently used subset cache
+import itertools # For catalog version numbers
+try:
+    import zstandard # For zstd compressed exports (optional)
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow # For columnar (Parquet) exports (optional)
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 ## Constants
+DATA_FILE = 'lego_data_cleaned.csv' # Cleaned data set the program loads
 MAX_YEAR = 2025 # Hardcoded max year
 MIN_YEAR = 2000 # Hardcoded min year
 CLUSTERS = 1000 # Number of clusters for K-Means, increase for more precision but slower and may not be good for recommendations based on preferences
 NUMBER_OF_SETS_PER_CLUSTER = 3
+COARSE_PARTITION_SIZE = 300 # Target number of sets per coarse partition in hierarchical clustering, keeps each fine fit small
+MAX_PARTITION_SIZE = 2 * COARSE_PARTITION_SIZE # Coarse partitions larger than this are split again, so no fine fit grows with the catalog
+HIERARCHICAL_CLUSTERING_MIN_SETS = 1500 # Similar sets uses hierarchical clustering from this many sets, below it a single K-Means fit is as fast
 CONFIDENCE_LEVEL = 0.95 # Confidence level for confidence interval calculations
+EXPORT_CHUNK_SIZE = 10000 # Number of sets written per chunk when exporting, keeps memory flat for large exports
+EXPORT_BUFFER_SIZE = 1024 * 1024 # Size in bytes of the write buffer used for exports
+EXPORT_GZIP_LEVEL = 1 # gzip compression level for exports, higher levels barely shrink the files but make exports CPU bound
+EXPORT_ZSTD_LEVEL = 3 # zstd compression level for exports
+REPLAY_PERCENTILES = [50, 90, 99] # Latency percentiles reported when replaying sessions
+SUBSET_CACHE_MAX_ENTRIES = 256 # Maximum number of queries kept in the subset cache
+SUBSET_CACHE_MAX_ROWS = 100000 # Maximum number of row indices kept across all cached queries
 
 ## Utility functions
+replay_session = None # Scripted session used in place of the keyboard when replaying, None during normal use
+record_file = None # File that typed inputs are recorded to for later replay, None when not recording
+# Read a line of input, from the replay script if a session is being replayed
+def read_input(prompt):
+    if replay_session:
+        return replay_session.next_input(prompt)
+    value = input(prompt)
+    if record_file:
+        record_file.write(f"{value}\n")
+        record_file.flush()
+    return value
+# Time a menu action and record it against the session being replayed
+@contextmanager
+def timed_action(action):
+    start = perf_counter()
+    yield
+    if replay_session and action.name not in ('EXIT', 'BACK_TO_MAIN_MENU'): # Leaving a menu does no work, so only adds noise
+        replay_session.record_latency(f"{type(action).__name__}.{action.name}", perf_counter() - start)
 # Read integer function
 def read_int(prompt, min_val, max_val): 
     while True:
         try:
-            value = int(input(prompt))
+            value = int(read_input(prompt))
             if min_val <= value <= max_val:
                 return value
             else:
@@ -36,7 +86,7 @@ def read_int(prompt, min_val, max_val):
 def read_float(prompt, min_val, max_val):
     while True:
         try:
-            value = float(input(prompt))
+            value = float(read_input(prompt))
             if min_val <= value <= max_val:
                 return value
             else:
@@ -46,13 +96,14 @@ def read_float(prompt, min_val, max_val):
 # Read string function
 def read_string(prompt):
     while True:
-        value = input(prompt).strip()
+        value = read_input(prompt).strip()
         if value:
             return value
         else:
             print("Input cannot be empty. Please enter a valid string.")
  
 ## Program Classes 
+catalog_versions = itertools.count(1) # Version numbers shared by all set lists, so a version identifies one list in one state
 # Class of a Lego set
 class LegoSet:
     def __init__(legoset, id, year, theme, themegroup, subtheme, name, image, price, pieces, minifigs, packaging, owncount, wantcount):
@@ -75,11 +126,20 @@ class LegoSet:
 # Class to hold a list of LegoSet objects
 class LegoData:
     def __init__(legos): # Initialize LegoData with an empty list
-        legos.list = [] # List to hold LegoSet objects
+        legos.list = [] # List to hold LegoSet objects, assigning it also sets the catalog version
+    @property
+    def list(legos):
+        return legos._list
+    @list.setter
+    def list(legos, lego_list): # Replacing the list is a new catalog version, so cached queries on the old list are never used
+        legos._list = lego_list
+        legos.version = next(catalog_versions) # Catalog version, changes whenever the list is replaced or sets are added or removed
     def add_set(legos, lego_set): # Add a LegoSet object to the list
         legos.list.append(lego_set)
+        legos.version = next(catalog_versions)
     def remove_set(legos, lego_set): # Remove a LegoSet object from the list
         legos.list.remove(lego_set) 
+        legos.version = next(catalog_versions)
     def num_of_sets(legos): # Return number of sets in the list
         return int(len(legos.list))
 
@@ -94,6 +154,71 @@ def csv_to_class_list(file):
            lego_list.append(LegoSet(*row))
     return lego_list
 
+## Subset cache
+# Least recently used cache of query results, stored as lists of row indices into the set list they came from
+class ResultCache:
+    def __init__(self, max_entries=SUBSET_CACHE_MAX_ENTRIES, max_rows=SUBSET_CACHE_MAX_ROWS):
+        self.entries = OrderedDict() # Dictionary of (catalog version, predicate) to row indices, oldest first
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.rows = 0 # Number of row indices currently cached
+        self.hits = 0
+        self.misses = 0
+    def get(self, version, predicate):
+        key = (version, predicate)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+    def put(self, version, predicate, row_ids):
+        if len(row_ids) > self.max_rows: # Too large to ever fit, don't evict everything else for it
+            return
+        key = (version, predicate)
+        if key in self.entries:
+            self.rows -= len(self.entries.pop(key))
+        self.entries[key] = row_ids
+        self.rows += len(row_ids)
+        while len(self.entries) > self.max_entries or self.rows > self.max_rows: # Entries for old catalog versions are never hit so age out first
+            _, evicted = self.entries.popitem(last=False)
+            self.rows -= len(evicted)
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+    def clear(self):
+        self.entries.clear()
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+subset_cache = ResultCache() # Cache shared by all searches and subsets
+NO_FILTER = object() # Default for unused query filters, distinct from None so None still only matches None
+# Return a LegoData of the sets matching every given filter, keyword is case insensitive and name is case sensitive
+def query_sets(lego_data, theme=NO_FILTER, themegroup=NO_FILTER, keyword=NO_FILTER, year=NO_FILTER, name=NO_FILTER):
+    if keyword is not NO_FILTER:
+        keyword = keyword.lower()
+    predicate = (theme, themegroup, keyword, year, name) # Normalised so equivalent queries share a cache entry
+    version = (lego_data.version, len(lego_data.list)) # Length guards against sets appended or removed on the list directly
+    row_ids = subset_cache.get(version, predicate)
+    if row_ids is None:
+        row_ids = []
+        for i, legoset in enumerate(lego_data.list):
+            if theme is not NO_FILTER and legoset.theme != theme:
+                continue
+            if themegroup is not NO_FILTER and legoset.themegroup != themegroup:
+                continue
+            if keyword is not NO_FILTER and keyword not in legoset.name.lower():
+                continue
+            if year is not NO_FILTER and legoset.year != year:
+                continue
+            if name is not NO_FILTER and name not in legoset.name:
+                continue
+            row_ids.append(i)
+        subset_cache.put(version, predicate, row_ids)
+    subset = LegoData()
+    subset.list = [lego_data.list[i] for i in row_ids]
+    return subset
+
 ## Theme functions
 # Search for theme group
 def list_theme_group(lego_data):
@@ -127,12 +252,7 @@ def list_themes_in_group(themegroup, lego_data):
     return None
 # Make a LegoData class to hold a list of LegoSet objects with the theme array
 def create_lego_data(target_theme, lego_data):
-    themed_lego_data = LegoData()
-    themed_lego_data.list = []
-    for legoset in lego_data.list:
-        if legoset.theme == target_theme:
-            themed_lego_data.add_set(legoset)
-    return themed_lego_data
+    return query_sets(lego_data, theme=target_theme)
 
 ## Searching for sets
 # Search for a set by ID
@@ -144,11 +264,8 @@ def search_setid(prompt, lego_data):
 def search_setname(prompt, lego_data):
     # Ask for a set name
     user_input = read_string(prompt)
-    possible_sets = []
     print("Found set:")
-    for lego_set in lego_data.list:
-        if user_input in lego_set.name:
-            possible_sets.append(lego_set)
+    possible_sets = query_sets(lego_data, name=user_input).list
     while len(possible_sets) > 15:
         print(f"{len(possible_sets)} sets found. Please refine your search.")
         refined_input = read_string("\nEnter part of set name to refine search: ")
@@ -298,6 +415,47 @@ def simple_cluster(lego_data: LegoData):
     for lego_set, label in zip(lego_data.list, cluster_labels):
         lego_set.cluster = label
     return lego_data
+# Cluster the sets of one coarse partition, returns labels local to the partition
+def fine_cluster(partition_data):
+    clusters = max(1, len(partition_data) // NUMBER_OF_SETS_PER_CLUSTER)
+    kmeans = KMeans(n_clusters=clusters, random_state=42, n_init='auto')
+    return kmeans.fit_predict(partition_data)
+# Split row indices into coarse partitions with Mini-Batch K-Means, splitting again any partition over MAX_PARTITION_SIZE
+def coarse_partitions(data_scaled, indices):
+    partitions = max(1, len(indices) // COARSE_PARTITION_SIZE)
+    coarse_kmeans = MiniBatchKMeans(n_clusters=partitions, random_state=42, n_init='auto')
+    coarse_labels = coarse_kmeans.fit_predict(data_scaled[indices])
+    partition_indices = []
+    for partition in range(partitions):
+        partition_members = indices[coarse_labels == partition]
+        if len(partition_members) == len(indices) and len(indices) > MAX_PARTITION_SIZE: # Points K-Means can't separate, split them evenly instead
+            partition_indices.extend(numpy.array_split(partition_members, partitions))
+        elif len(partition_members) > MAX_PARTITION_SIZE:
+            partition_indices.extend(coarse_partitions(data_scaled, partition_members))
+        elif len(partition_members) > 0: # Skip partitions left empty by the coarse fit
+            partition_indices.append(partition_members)
+    return partition_indices
+# Cluster lego sets in two levels, coarse partitions first then fine clusters within each partition in parallel
+def hierarchical_cluster(lego_data: LegoData):
+    cluster_lego_data = []
+    for lego_set in lego_data.list:
+        cluster_lego_data.append([lego_set.themegroup_number, lego_set.price, lego_set.pieces, lego_set.minifigs, lego_set.year])
+    scaler = StandardScaler()
+    data_scaled = scaler.fit_transform(cluster_lego_data)
+    # Partition the sets coarsely with Mini-Batch K-Means
+    partition_indices = coarse_partitions(data_scaled, numpy.arange(lego_data.num_of_sets()))
+    print(f"Partitioned into {len(partition_indices)} coarse clusters, largest has {max(len(indices) for indices in partition_indices)} sets.")
+    # Apply K-Means within each partition, keeping about NUMBER_OF_SETS_PER_CLUSTER sets per cluster
+    fine_labels = Parallel(n_jobs=-1, prefer="threads")(delayed(fine_cluster)(data_scaled[indices]) for indices in partition_indices)
+    cluster_labels = numpy.zeros(lego_data.num_of_sets(), dtype=int)
+    offset = 0
+    for indices, labels in zip(partition_indices, fine_labels):
+        cluster_labels[indices] = labels + offset # Offset labels so clusters are unique across partitions
+        offset += labels.max() + 1
+    print(f"Clustered into {offset} clusters.")
+    for lego_set, label in zip(lego_data.list, cluster_labels):
+        lego_set.cluster = label
+    return lego_data
 
 ## Set recommendation system
 # Recommendation options enumeration
@@ -319,22 +477,25 @@ def recommendation_menu(lego_data, favourites):
         rec_choice = read_int("Enter your choice (1-5): ",1,5)
         if rec_choice in range(1, 6):
             rec_choice = RecommendationOptions(int(rec_choice))
-            if rec_choice == RecommendationOptions.RANDOM_SET:
-                recommend_set(lego_data)
-            elif rec_choice == RecommendationOptions.TAILORED_SET:
-                tailored_set(lego_data)
-            elif rec_choice == RecommendationOptions.FIND_SIMILAR:
-                target_set = ask_for_search(lego_data)
-                if target_set:
-                    themed_lego_data = create_lego_data(target_set.theme, lego_data)
-                    similar_sets(target_set, themed_lego_data)
-            elif rec_choice == RecommendationOptions.ADD_TO_FAVOURITES:
-                set_to_add = ask_for_search(lego_data)
-                if set_to_add:
-                    favourites.add_set(set_to_add)
-                    print("Set added to favourites.")
-            elif rec_choice == RecommendationOptions.EXIT:
-                break
+            with timed_action(rec_choice):
+                if rec_choice == RecommendationOptions.RANDOM_SET:
+                    recommend_set(lego_data)
+                elif rec_choice == RecommendationOptions.TAILORED_SET:
+                    tailored_set(lego_data)
+                elif rec_choice == RecommendationOptions.FIND_SIMILAR:
+                    target_set = ask_for_search(lego_data)
+                    if target_set:
+                        themed_lego_data = create_lego_data(target_set.theme, lego_data)
+                        found_sets = similar_sets(target_set, themed_lego_data)
+                        if found_sets:
+                            offer_export(found_sets, "these similar sets")
+                elif rec_choice == RecommendationOptions.ADD_TO_FAVOURITES:
+                    set_to_add = ask_for_search(lego_data)
+                    if set_to_add:
+                        favourites.add_set(set_to_add)
+                        print("Set added to favourites.")
+                elif rec_choice == RecommendationOptions.EXIT:
+                    break
         else:
             print("Invalid input. Please enter a number between 1 and 5.")
 # Recommend a random set
@@ -345,14 +506,13 @@ def recommend_set(lego_data):
     return recommended_set
 # Recommend a set based on user preferences
 def tailored_set(lego_data):
-    lego_data.add_set(ask_for_set_pref(lego_data))
+    target_set = ask_for_set_pref(lego_data)
     print("Set preferences recorded. \n")
-    target_set = find_set_by_id("TARGET_ID", lego_data)
     print(f"Looking for... Pieces: {target_set.pieces}, Price: ${target_set.price}, Minifigs: {target_set.minifigs}, Theme: {target_set.theme}")
     themed_lego_data = create_lego_data(target_set.theme, lego_data)
+    themed_lego_data.add_set(target_set) # Cluster the target with its theme without adding it to the catalog, so cached queries stay valid
     print(f"Number of sets in themed data: {themed_lego_data.num_of_sets()}")
     similar_sets(target_set, themed_lego_data, detailed_clustering=False)
-    lego_data.remove_set(target_set)
 def ask_for_set_pref(lego_data):
     print("\nEnter details for the new Lego set:")
     legoset = LegoSet("TARGET_ID", 0, "Theme", "Themegroup", "Subtheme", "Name", "Image", 0.0, 0, 0, "Packaging", 0, 0)
@@ -365,10 +525,15 @@ def ask_for_set_pref(lego_data):
     legoset.pieces = int(-19.079+9.288*legoset.price)
     return legoset
 # Find similar sets based on cluster
-def similar_sets(target_set, lego_data, detailed_clustering=True):
+# hierarchical forces two level clustering on (True) or off (False), None picks it from the number of sets
+def similar_sets(target_set, lego_data, detailed_clustering=True, hierarchical=None):
     # Find sets in the same cluster as the target set
     print("Clustering sets...")
-    if detailed_clustering:
+    if hierarchical is None:
+        hierarchical = lego_data.num_of_sets() >= HIERARCHICAL_CLUSTERING_MIN_SETS
+    if detailed_clustering and hierarchical:
+        hierarchical_cluster(lego_data)
+    elif detailed_clustering:
         cluster(lego_data)
     else:
         simple_cluster(lego_data)
@@ -379,6 +544,7 @@ def similar_sets(target_set, lego_data, detailed_clustering=True):
         print_set_details(set)
     if not similar_sets:
         print("No similar sets found.")
+    return similar_sets
 
 ## Specific set system
 # Set menu options enumeration
@@ -400,21 +566,22 @@ def set_menu(lego_set, favourites):
         set_choice = read_int("Enter your choice (1-5): ",1,5)
         if set_choice in range(1, 6):
             set_choice = SetMenuOptions(int(set_choice))
-            if set_choice == SetMenuOptions.FULL_SET_DETAILS:
-                print_set_details_full(lego_set)
-            elif set_choice == SetMenuOptions.GET_LINK:
-                set_link(lego_set)
-            elif set_choice == SetMenuOptions.DISPLAY_IMAGE:
-                display_set_image(lego_set)
-            elif set_choice == SetMenuOptions.ADD_TO_FAVOURITES:
-                if lego_set:
-                    if lego_set in favourites.list:
-                        print("Set is already in favourites.")
-                    else:
-                        favourites.add_set(lego_set)
-                        print("Set added to favourites.")
-            elif set_choice == SetMenuOptions.EXIT:
-                break
+            with timed_action(set_choice):
+                if set_choice == SetMenuOptions.FULL_SET_DETAILS:
+                    print_set_details_full(lego_set)
+                elif set_choice == SetMenuOptions.GET_LINK:
+                    set_link(lego_set)
+                elif set_choice == SetMenuOptions.DISPLAY_IMAGE:
+                    display_set_image(lego_set)
+                elif set_choice == SetMenuOptions.ADD_TO_FAVOURITES:
+                    if lego_set:
+                        if lego_set in favourites.list:
+                            print("Set is already in favourites.")
+                        else:
+                            favourites.add_set(lego_set)
+                            print("Set added to favourites.")
+                elif set_choice == SetMenuOptions.EXIT:
+                    break
         else:
             print("Invalid input. Please enter a number between 1 and 4.")
 # Prints brief details of a LegoSet
@@ -432,16 +599,14 @@ def print_set_details_full(lego_set):
 # Get link to a set given set
 def set_link(lego_set):
     if lego_set:
-        name_formatted = lego_set.name.replace(' ', '-')
-        name_formatted = name_formatted.replace(':', '')
-        name_formatted = name_formatted.replace('.', '')
-        name_formatted = name_formatted.replace("'", '')
-        print(f"Link to set {lego_set.id}: https://brickset.com/sets/{lego_set.id}-1/{name_formatted}")
+        print(f"Link to set {lego_set.id}: {set_links([lego_set.id], [lego_set.name])[0]}")
     else:
         print("No set provided to get link.")
 # Display image of a set given its URL
 def display_set_image(lego_set):
-    if lego_set and lego_set.image:
+    if replay_session: # Replayed sessions never download images or open an image viewer
+        print("Image display skipped while replaying.")
+    elif lego_set and lego_set.image:
         try:
             image_url = f"https://images.brickset.com/sets/images/{lego_set.image}.jpg"
             image_path = "temp_image.jpg"
@@ -454,6 +619,160 @@ def display_set_image(lego_set):
     else:
         print("No image URL available for this set.")
 
+## Export functions
+# Export format options enumeration
+class ExportFormats(Enum):
+    CSV = 1
+    JSONL = 2
+    PARQUET = 3
+# Export compression options enumeration
+class CompressionOptions(Enum):
+    NONE = 1
+    GZIP = 2
+    ZSTD = 3
+# Column headers of the data set CSV and the type each column is converted to
+CATALOG_COLUMNS = [('ID', str), ('Year', int), ('Theme', str), ('ThemeGroup', str), ('Subtheme', str), ('Name', str), ('Image', str), ('Price', float), ('Pieces', int), ('Minifigs', int), ('Packaging', str), ('OwnCount', int), ('WantCount', int)]
+# Column headers and the LegoSet attribute each one is read from
+EXPORT_COLUMNS = [('ID', 'id'), ('Name', 'name'), ('Year', 'year'), ('Theme', 'theme'), ('ThemeGroup', 'themegroup'), ('Subtheme', 'subtheme'), ('Image', 'image'), ('Price', 'price'), ('Pieces', 'pieces'), ('Minifigs', 'minifigs'), ('Packaging', 'packaging'), ('OwnCount', 'owncount'), ('WantCount', 'wantcount')]
+EXPORT_EXTENSIONS = {ExportFormats.CSV: '.csv', ExportFormats.JSONL: '.jsonl', ExportFormats.PARQUET: '.parquet'}
+COMPRESSION_EXTENSIONS = {CompressionOptions.NONE: '', CompressionOptions.GZIP: '.gz', CompressionOptions.ZSTD: '.zst'}
+PARQUET_COMPRESSION = {CompressionOptions.NONE: 'none', CompressionOptions.GZIP: 'gzip', CompressionOptions.ZSTD: 'zstd'}
+PARQUET_COMPRESSION_LEVEL = {CompressionOptions.NONE: None, CompressionOptions.GZIP: EXPORT_GZIP_LEVEL, CompressionOptions.ZSTD: EXPORT_ZSTD_LEVEL}
+# Build brickset links for whole columns of IDs and names at once
+def set_links(ids, names):
+    return ["https://brickset.com/sets/" + set_id + "-1/" + name.replace(' ', '-').replace(':', '').replace('.', '').replace("'", '') for set_id, name in zip(ids, names)]
+# Load the data set CSV as typed columns in export order, so catalog exports never build LegoSet objects
+def csv_to_columns(file):
+    with open(file, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)  # Skip header row
+        rows = list(zip(*reader)) # Transpose rows into columns
+    if not rows:
+        rows = [()] * len(CATALOG_COLUMNS)
+    catalog = {}
+    for (header, column_type), column in zip(CATALOG_COLUMNS, rows):
+        catalog[header] = column if column_type is str else list(map(column_type, column))
+    columns = {}
+    for header, attribute in EXPORT_COLUMNS:
+        columns[header] = catalog[header]
+    columns['Link'] = set_links(columns['ID'], columns['Name'])
+    return columns
+# Split typed columns into chunks covering rows start to stop
+def column_chunks(columns, start=0, stop=None):
+    rows = len(columns['ID'])
+    stop = rows if stop is None else min(stop, rows)
+    for chunk_start in range(start, max(stop, start + 1), EXPORT_CHUNK_SIZE): # Always yield at least one chunk so empty exports still get a header
+        chunk_stop = min(chunk_start + EXPORT_CHUNK_SIZE, stop)
+        yield {header: column[chunk_start:chunk_stop] for header, column in columns.items()}
+# Build typed columns (one list per attribute) for a list of sets
+def set_columns(lego_sets):
+    columns = {}
+    for header, attribute in EXPORT_COLUMNS:
+        columns[header] = list(map(operator.attrgetter(attribute), lego_sets))
+    columns['Link'] = set_links(columns['ID'], columns['Name'])
+    return columns
+# Split a list of sets into chunks of columns so large exports never hold every row at once
+def set_column_chunks(lego_sets):
+    for start in range(0, max(len(lego_sets), 1), EXPORT_CHUNK_SIZE): # Always yield at least one chunk so empty exports still get a header
+        yield set_columns(lego_sets[start:start + EXPORT_CHUNK_SIZE])
+# Build the export filename from a base name, format and compression
+def export_filename(filename, export_format, compression):
+    if export_format == ExportFormats.PARQUET: # Parquet compresses internally so the extension stays the same
+        return f"{filename}{EXPORT_EXTENSIONS[export_format]}"
+    return f"{filename}{EXPORT_EXTENSIONS[export_format]}{COMPRESSION_EXTENSIONS[compression]}"
+# Open a buffered text file for writing, compressed if requested
+def open_export_file(filename, compression):
+    if compression == CompressionOptions.GZIP:
+        return gzip.open(filename, 'wt', compresslevel=EXPORT_GZIP_LEVEL, newline='', encoding='utf-8')
+    elif compression == CompressionOptions.ZSTD:
+        return zstandard.open(filename, 'wt', cctx=zstandard.ZstdCompressor(level=EXPORT_ZSTD_LEVEL), newline='', encoding='utf-8')
+    return open(filename, 'w', newline='', encoding='utf-8', buffering=EXPORT_BUFFER_SIZE)
+# Convert a whole column to CSV text at once, quoting only the values that need it (same output as csv.writer)
+def csv_text_column(column):
+    if not column or not isinstance(column[0], str):
+        return list(map(str, column))
+    joined = ''.join(column)
+    if ',' not in joined and '"' not in joined and '\r' not in joined and '\n' not in joined: # Most columns never need quoting
+        return column
+    return ['"' + value.replace('"', '""') + '"' if (',' in value or '"' in value or '\r' in value or '\n' in value) else value for value in column]
+# Write chunks of columns to a CSV or JSONL file
+def write_text_export(column_chunks, filename, export_format, compression):
+    with open_export_file(filename, compression) as exportfile:
+        first_chunk = True
+        for columns in column_chunks:
+            if export_format == ExportFormats.CSV:
+                if first_chunk:
+                    exportfile.write(','.join(columns) + '\r\n')
+                text_columns = [csv_text_column(column) for column in columns.values()]
+                exportfile.writelines(','.join(row) + '\r\n' for row in zip(*text_columns))
+            else:
+                headers = list(columns)
+                exportfile.writelines(json.dumps(dict(zip(headers, row))) + '\n' for row in zip(*columns.values())) # Empty chunks write nothing
+            first_chunk = False
+# Parquet schema of an export, typed from CATALOG_COLUMNS so it never depends on the data being exported
+def parquet_schema():
+    column_types = dict(CATALOG_COLUMNS)
+    arrow_types = {str: pyarrow.string(), int: pyarrow.int64(), float: pyarrow.float64()}
+    fields = [(header, arrow_types[column_types[header]]) for header, attribute in EXPORT_COLUMNS]
+    fields.append(('Link', pyarrow.string()))
+    return pyarrow.schema(fields)
+# Write chunks of columns to a Parquet file, one row group per chunk
+def write_parquet_export(column_chunks, filename, compression):
+    schema = parquet_schema()
+    with pyarrow.parquet.ParquetWriter(filename, schema, compression=PARQUET_COMPRESSION[compression], compression_level=PARQUET_COMPRESSION_LEVEL[compression]) as writer:
+        for columns in column_chunks:
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+# Export chunks of columns to a file, returns the filename written or None if the export could not be done
+def export_columns(column_chunks, filename, export_format=ExportFormats.CSV, compression=CompressionOptions.NONE):
+    if compression == CompressionOptions.ZSTD and zstandard is None and export_format != ExportFormats.PARQUET:
+        print("zstd compression requires the zstandard package to be installed.")
+        return None
+    if export_format == ExportFormats.PARQUET and pyarrow is None:
+        print("Parquet export requires the pyarrow package to be installed.")
+        return None
+    target = os.devnull if replay_session else filename # Replayed sessions do the work of an export without leaving files behind
+    if export_format == ExportFormats.PARQUET:
+        write_parquet_export(column_chunks, target, compression)
+    else:
+        write_text_export(column_chunks, target, export_format, compression)
+    return filename
+# Export a list of sets (e.g. favourites, a statistics subset, similar sets or a slice of the catalog)
+def export_sets(lego_sets, filename, export_format=ExportFormats.CSV, compression=CompressionOptions.NONE):
+    return export_columns(set_column_chunks(lego_sets), filename, export_format, compression)
+# Export rows start to stop of the catalog loaded with csv_to_columns, straight from its typed columns
+def export_catalog(columns, filename, start=0, stop=None, export_format=ExportFormats.CSV, compression=CompressionOptions.NONE):
+    return export_columns(column_chunks(columns, start, stop), filename, export_format, compression)
+# Ask user for a filename, format and compression, returns the full filename, format and compression
+def ask_for_export_options(prompt):
+    filename = read_string(prompt)
+    while filename == "" or any(c in filename for c in '<>:"/\\|?* '):
+        print("Invalid filename. Please avoid using special characters <>:\"/\\|?* and spaces.")
+        filename = read_string(prompt)
+    print("Export formats:")
+    print("1. CSV")
+    print("2. JSON Lines")
+    print("3. Parquet")
+    export_format = ExportFormats(read_int("Enter a format (1-3): ", 1, 3))
+    print("Compression options:")
+    print("1. None")
+    print("2. gzip")
+    print("3. zstd")
+    compression = CompressionOptions(read_int("Enter a compression option (1-3): ", 1, 3))
+    return export_filename(filename, export_format, compression), export_format, compression
+# Ask user whether to export the given sets, and export them if so
+def offer_export(lego_sets, description):
+    while True:
+        again = read_string(f"Would you like to export {description}? (y/n): ")
+        if again.lower() == 'y':
+            filename, export_format, compression = ask_for_export_options("Enter filename to export to: ")
+            if export_sets(lego_sets, filename, export_format, compression):
+                print(f"Exported {len(lego_sets)} sets to {filename}")
+            return
+        if again.lower() == 'n':
+            return
+        else:
+            print("Invalid input")
+
 ## Favourites system
 # Favourites menu options enumeration
 class FavouritesMenuOptions(Enum):
@@ -473,7 +792,14 @@ def print_favourites_menu():
 # Favourites class to manage favourite Lego sets
 class Favourites:
     def __init__(self):
-        self.list = []
+        self.list = [] # Assigning the list also sets the catalog version
+    @property
+    def list(self):
+        return self._list
+    @list.setter
+    def list(self, lego_list): # Replacing the list is a new catalog version, so cached queries on the old list are never used
+        self._list = lego_list
+        self.version = next(catalog_versions) # Catalog version, changes whenever the list is replaced or sets are added or removed
     def avg_price(self):
         total_price = sum(lego_set.price for lego_set in self.list)
         return total_price / len(self.list) if self.list else 0
@@ -492,8 +818,10 @@ class Favourites:
         return None
     def add_set(self, lego_set):
         self.list.append(lego_set)
+        self.version = next(catalog_versions)
     def remove_set(self, lego_set):
         self.list.remove(lego_set)
+        self.version = next(catalog_versions)
     def print_favourites(self):
         for i, lego_set in enumerate(self.list):
             print(f"{i + 1}. ", end="")
@@ -501,13 +829,9 @@ class Favourites:
         print(f"Average Price: ${self.avg_price():.2f}")
         print(f"Average Pieces: {self.avg_pieces():.2f}")
         print(f"Most Common Theme: {self.common_theme()}")
-    def export_favourites(self, filename):
-        with open(filename, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['ID', 'Name', 'Year', 'Theme', 'ThemeGroup', 'Subtheme', 'Image', 'Price ', 'Pieces', 'Minifigs', 'Packaging', 'OwnCount', 'WantCount', 'Link'])
-            for lego_set in self.list:
-                writer.writerow([lego_set.id, lego_set.name, lego_set.year, lego_set.theme, lego_set.themegroup, lego_set.subtheme, lego_set.image, lego_set.price, lego_set.pieces, lego_set.minifigs, lego_set.packaging, lego_set.owncount, lego_set.wantcount, f"https://brickset.com/sets/{lego_set.id}-1/{lego_set.name.replace(' ', '-')}"])
-        print(f"Favourites exported to {filename}")
+    def export_favourites(self, filename, export_format=ExportFormats.CSV, compression=CompressionOptions.NONE):
+        if export_sets(self.list, filename, export_format, compression):
+            print(f"Favourites exported to {filename}")
 # Favourites menu loop
 def favourites_menu(favourites, lego_data):
     while True:
@@ -515,43 +839,41 @@ def favourites_menu(favourites, lego_data):
         fav_choice = read_int("Enter your choice (1-5): ",1,5)
         if fav_choice in range(1, 6):
             fav_choice = FavouritesMenuOptions(int(fav_choice))
-            if fav_choice == FavouritesMenuOptions.VIEW_FAVOURITES:
-                favourites.print_favourites()
-            elif fav_choice == FavouritesMenuOptions.ADD_TO_FAVOURITES:
-                set_to_add = ask_for_search(lego_data)
-                if set_to_add:
-                    if set_to_add in favourites.list:
-                        print("Set is already in favourites.")
-                        set_to_add = ask_for_search(lego_data)
+            with timed_action(fav_choice):
+                if fav_choice == FavouritesMenuOptions.VIEW_FAVOURITES:
+                    favourites.print_favourites()
+                elif fav_choice == FavouritesMenuOptions.ADD_TO_FAVOURITES:
+                    set_to_add = ask_for_search(lego_data)
+                    if set_to_add:
+                        if set_to_add in favourites.list:
+                            print("Set is already in favourites.")
+                            set_to_add = ask_for_search(lego_data)
+                        else:
+                            favourites.add_set(set_to_add)
+                            print("Set added to favourites.")
+                elif fav_choice == FavouritesMenuOptions.REMOVE_FROM_FAVOURITES:
+                    if len(favourites.list) == 0:
+                        print("No sets in favourites to remove.")
+                        continue
+                    elif len(favourites.list) <= 15:
+                        print("Favourites:")
+                        for lego_set in favourites.list:
+                            print_set_details(lego_set)
+                        set_id = read_string("Enter the ID of the set to remove: ")
+                        set_to_remove = find_set_by_id(set_id, favourites)
                     else:
-                        favourites.add_set(set_to_add)
-                        print("Set added to favourites.")
-            elif fav_choice == FavouritesMenuOptions.REMOVE_FROM_FAVOURITES:
-                if len(favourites.list) == 0:
-                    print("No sets in favourites to remove.")
-                    continue
-                elif len(favourites.list) <= 15:
-                    print("Favourites:")
-                    for lego_set in favourites.list:
-                        print_set_details(lego_set)
-                    set_id = read_string("Enter the ID of the set to remove: ")
-                    set_to_remove = find_set_by_id(set_id, favourites)
-                else:
-                    print(f"{len(favourites.list)} sets in favourites. Please search to remove a set.")
-                    set_to_remove = ask_for_search(favourites)
-                if set_to_remove:
-                    favourites.remove_set(set_to_remove)
-                    print("Set removed from favourites.")
-                else:
-                    print("Set not found in favourites.")
-            elif fav_choice == FavouritesMenuOptions.EXPORT_FAVOURITES:
-                filename = read_string("Enter filename to export favourites: ")
-                while filename == "" or any(c in filename for c in '<>:"/\\|?* '):
-                    print("Invalid filename. Please avoid using special characters <>:\"/\\|?* and spaces.")
-                    filename = read_string("Enter filename to export favourites: ")
-                favourites.export_favourites(f"{filename}.csv")
-            elif fav_choice == FavouritesMenuOptions.BACK_TO_MAIN_MENU:
-                break
+                        print(f"{len(favourites.list)} sets in favourites. Please search to remove a set.")
+                        set_to_remove = ask_for_search(favourites)
+                    if set_to_remove:
+                        favourites.remove_set(set_to_remove)
+                        print("Set removed from favourites.")
+                    else:
+                        print("Set not found in favourites.")
+                elif fav_choice == FavouritesMenuOptions.EXPORT_FAVOURITES:
+                    filename, export_format, compression = ask_for_export_options("Enter filename to export favourites: ")
+                    favourites.export_favourites(filename, export_format, compression)
+                elif fav_choice == FavouritesMenuOptions.BACK_TO_MAIN_MENU:
+                    break
         else:
             print("Invalid input. Please enter a number between 1 and 5.")
 
@@ -578,26 +900,17 @@ def types_of_subsets(lego_data, favourites):
         return create_lego_data(theme, lego_data)
     elif choice == SubsetOptions.THEME_GROUP.value:
         themegroup = list_theme_group(lego_data)
-        themedgroup_lego_data = LegoData()
-        for legoset in lego_data.list:
-            if legoset.themegroup == themegroup:
-                themedgroup_lego_data.add_set(legoset)
+        themedgroup_lego_data = query_sets(lego_data, themegroup=themegroup)
         print(f"\nCreating subset for theme group: {themegroup}")
         return themedgroup_lego_data
     elif choice == SubsetOptions.KEYWORD.value:
         keyword = read_string("Enter keyword to search for in set names: ")
-        keyword_lego_data = LegoData()
-        for legoset in lego_data.list:
-            if keyword.lower() in legoset.name.lower():
-                keyword_lego_data.add_set(legoset)
+        keyword_lego_data = query_sets(lego_data, keyword=keyword)
         print(f"\nCreating subset for keyword: {keyword}")
         return keyword_lego_data
     elif choice == SubsetOptions.YEAR_RANGE.value:
         year = read_int(f"Enter year (e.g., {MIN_YEAR}-{MAX_YEAR}): ", MIN_YEAR, MAX_YEAR)
-        year_lego_data = LegoData()
-        for legoset in lego_data.list:
-            if legoset.year == year:
-                year_lego_data.add_set(legoset)
+        year_lego_data = query_sets(lego_data, year=year)
         print(f"\nCreating subset for year: {year}")
         return year_lego_data
     elif choice == SubsetOptions.FAVOURITES.value:
@@ -707,13 +1020,8 @@ def welcome():
     print("Welcome to the Lego Set Recommender!")
     print("You can get recommendations based on your preferences or explore similar sets.")
     print("Let's find your perfect Lego set!")
-# Main program loop
-def main():
-    welcome()
-    lego_data = LegoData()
-    favourites = Favourites()
-    print("Loading Lego data...")
-    lego_data.list = csv_to_class_list('lego_data_cleaned.csv')
+# Main menu loop
+def main_menu(lego_data, favourites):
     while True:
         print_menu()
         choice = read_int("Enter your choice (1-5): ",1,5)
@@ -722,7 +1030,8 @@ def main():
             if choice == MenuOptions.RECOMMENDATIONS:
                 recommendation_menu(lego_data, favourites)
             elif choice == MenuOptions.SET_FINDER:
-                searched_set = ask_for_search(lego_data)
+                with timed_action(choice):
+                    searched_set = ask_for_search(lego_data)
                 if searched_set:
                     set_menu(searched_set, favourites)
                 else:
@@ -730,15 +1039,132 @@ def main():
             elif choice == MenuOptions.FAVOURITES:
                 favourites_menu(favourites, lego_data)
             elif choice == MenuOptions.STATISTICS:
-                subset = types_of_subsets(lego_data, favourites)
-                if subset:
-                    attribute_choice = attribute_menu()
-                    analyse_attribute(lego_data, subset, attribute_choice)
-                else:
-                    print("No sets found in the selected subset for analysis.")
+                with timed_action(choice):
+                    subset = types_of_subsets(lego_data, favourites)
+                    if subset:
+                        attribute_choice = attribute_menu()
+                        analyse_attribute(lego_data, subset, attribute_choice)
+                        offer_export(subset.list, "this subset")
+                    else:
+                        print("No sets found in the selected subset for analysis.")
             elif choice == MenuOptions.EXIT:
                 print("Thank you for using the Lego Set Recommender. Goodbye!")
                 break
         else:
             print("Invalid input. Please enter a number between 1 and 5.")
-main()
+# Main program loop, optionally recording typed inputs to a replay script
+def main(record=None):
+    global record_file
+    welcome()
+    lego_data = LegoData()
+    favourites = Favourites()
+    print("Loading Lego data...")
+    lego_data.list = csv_to_class_list(DATA_FILE)
+    if record:
+        record_file = open(record, 'w')
+    try:
+        main_menu(lego_data, favourites)
+    finally:
+        if record_file:
+            record_file.close()
+            record_file = None
+
+## Session replay
+replay_lego_data = None # Lego data loaded once in each replay worker process
+# Scripted stand-in for keyboard input, records how long each menu action takes
+class ReplaySession:
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.position = 0
+        self.latencies = {} # Dictionary of menu action to list of latencies in seconds
+    def next_input(self, prompt):
+        if self.position >= len(self.inputs):
+            raise EOFError(f"Replay script ran out of input at prompt: {prompt.strip()}")
+        value = self.inputs[self.position]
+        self.position += 1
+        return value
+    def record_latency(self, action, seconds):
+        if action in self.latencies:
+            self.latencies[action].append(seconds)
+        else:
+            self.latencies[action] = [seconds]
+# Read a replay script, every line is one input exactly as it was typed
+def read_replay_script(file):
+    with open(file, 'r') as scriptfile:
+        return [line.rstrip('\r\n') for line in scriptfile]
+# Load the Lego data once per replay worker process
+def init_replay_worker():
+    global replay_lego_data
+    replay_lego_data = LegoData()
+    replay_lego_data.list = csv_to_class_list(DATA_FILE)
+# Run one scripted session through the menus, returns the script, its action latencies and any error
+def run_replay_session(script_file):
+    global replay_session
+    replay_session = ReplaySession(read_replay_script(script_file))
+    hits, misses = subset_cache.hits, subset_cache.misses
+    error = None
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        try:
+            main_menu(replay_lego_data, Favourites())
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    latencies = replay_session.latencies
+    replay_session = None
+    return script_file, latencies, error, subset_cache.hits - hits, subset_cache.misses - misses
+# Print latency percentiles for each menu action
+def print_replay_report(latencies, sessions, errors, cache_hits, cache_misses):
+    print(f"\nReplayed {sessions} sessions, {errors} failed (timings from failed sessions are not included).")
+    cache_lookups = cache_hits + cache_misses
+    if cache_lookups:
+        print(f"Subset cache: {cache_hits} hits, {cache_misses} misses ({cache_hits / cache_lookups:.1%} hit rate)")
+    header = f"{'Action':<45}{'Count':>8}"
+    for percentile in REPLAY_PERCENTILES:
+        header += f"{f'p{percentile} (ms)':>12}"
+    print(header + f"{'Max (ms)':>12}")
+    for action in sorted(latencies):
+        values = numpy.array(latencies[action]) * 1000
+        row = f"{action:<45}{len(values):>8}"
+        for value in numpy.percentile(values, REPLAY_PERCENTILES):
+            row += f"{value:>12.1f}"
+        print(row + f"{values.max():>12.1f}")
+# Replay scripted sessions concurrently across processes and report latency percentiles per menu action
+def replay(script_files, processes=None, repeat=1):
+    sessions = [script_file for script_file in script_files for _ in range(repeat)]
+    latencies = {}
+    errors = 0
+    cache_hits = 0
+    cache_misses = 0
+    print(f"Replaying {len(sessions)} sessions...")
+    with multiprocessing.Pool(processes, initializer=init_replay_worker) as pool:
+        for script_file, session_latencies, error, session_hits, session_misses in pool.imap_unordered(run_replay_session, sessions):
+            cache_hits += session_hits
+            cache_misses += session_misses
+            if error: # Timings from a session that did not finish would skew the percentiles, so leave them out
+                errors += 1
+                print(f"Session {script_file} failed: {error}")
+                continue
+            for action, values in session_latencies.items():
+                latencies.setdefault(action, []).extend(values)
+    print_replay_report(latencies, len(sessions), errors, cache_hits, cache_misses)
+    return latencies
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lego Set Recommender")
+    parser.add_argument('--record', metavar='FILE', help="record typed inputs to a replay script")
+    parser.add_argument('--replay', nargs='+', metavar='SCRIPT', help="replay scripted sessions instead of reading from the keyboard")
+    parser.add_argument('--processes', type=int, default=None, help="number of processes to replay sessions across (default: CPU count)")
+    parser.add_argument('--repeat', type=int, default=1, help="number of times to replay each script")
+    parser.add_argument('--export-catalog', metavar='FILE', help="export rows --start to --stop of the catalog to FILE and exit")
+    parser.add_argument('--start', type=int, default=0, help="first catalog row to export (default: 0)")
+    parser.add_argument('--stop', type=int, default=None, help="catalog row to stop exporting before (default: end of catalog)")
+    parser.add_argument('--format', choices=[option.name.lower() for option in ExportFormats], default='csv', help="catalog export format (default: csv)")
+    parser.add_argument('--compression', choices=[option.name.lower() for option in CompressionOptions], default='none', help="catalog export compression (default: none)")
+    args = parser.parse_args()
+    if args.export_catalog:
+        filename = export_catalog(csv_to_columns(DATA_FILE), args.export_catalog, args.start, args.stop, ExportFormats[args.format.upper()], CompressionOptions[args.compression.upper()])
+        if filename:
+            print(f"Catalog exported to {filename}")
+    elif args.replay:
+        replay(args.replay, args.processes, args.repeat)
+    else:
+        main(args.record)